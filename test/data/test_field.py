@@ -403,6 +403,30 @@ class TestField(TorchtextTestCase):
         numericalized_float = float_field.numericalize(test_float_data)
         assert_allclose(numericalized_float.data.numpy(), [0.55, 0.05, 1.955, 0.1, 5.1])
 
+    def test_process_matches_pad_and_numericalize(self):
+        batch = [["a", "b", "c"], ["b"], ["c", "oov", "a", "a"], []]
+        for kwargs in ({}, {"batch_first": True}, {"include_lengths": True},
+                       {"init_token": "<s>", "eos_token": "</s>"},
+                       {"pad_first": True, "eos_token": "</s>"}):
+            field = data.Field(**kwargs)
+            field.build_vocab([["a", "b", "c"]])
+            expected = field.numericalize(field.pad(batch))
+            processed = field.process(batch)
+            if field.include_lengths:
+                assert processed[1].tolist() == expected[1].tolist()
+                processed, expected = processed[0], expected[0]
+            assert processed.dtype == expected.dtype
+            assert processed.tolist() == expected.tolist()
+
+        for unk_token in (None, "<unk>"):
+            field = data.Field(pad_token=None, unk_token=unk_token)
+            field.build_vocab([["a", "b", "c"]])
+            stoi = dict(field.vocab.stoi)
+            batch = [["a", "b"], ["c", "a"]]
+            expected = field.numericalize(field.pad(batch))
+            assert field.process(batch).tolist() == expected.tolist()
+            assert dict(field.vocab.stoi) == stoi
+
     def test_errors(self):
         # Test that passing a non-tuple (of data and length) to numericalize
         # with Field.include_lengths = True raises an error.
@@ -0,0 +1,260 @@
+from __future__ import unicode_literals
+import torchtext.data as data
+
+from ..common.torchtext_test_case import TorchtextTestCase
+
+
+class TestIterator(TorchtextTestCase):
+    def make_dataset(self, lengths):
+        text_field = data.Field()
+        index_field = data.Field(sequential=False, use_vocab=False)
+        fields = [("text", text_field), ("index", index_field)]
+        examples = [data.Example.fromlist([" ".join(["a"] * n), i], fields)
+                    for i, n in enumerate(lengths)]
+        dataset = data.Dataset(examples, fields)
+        text_field.build_vocab(dataset)
+        return dataset
+
+    def test_sorted_data_is_stable_and_cached(self):
+        dataset = self.make_dataset([3, 1, 2, 1, 3, 2])
+        itr = data.Iterator(dataset, batch_size=2, train=False,
+                            sort_key=lambda x: len(x.text))
+        expected = [1, 3, 2, 5, 0, 4]
+        self.assertEqual([ex.index for ex in itr.data()], expected)
+        order = itr._sort_order
+        self.assertEqual([ex.index for ex in itr.data()], expected)
+        self.assertIs(itr._sort_order, order)
+
+    def test_sorted_data_cache_invalidation(self):
+        dataset = self.make_dataset([3, 1, 2])
+        itr = data.Iterator(dataset, batch_size=2, train=False,
+                            sort_key=lambda x: len(x.text))
+        self.assertEqual([ex.index for ex in itr.data()], [1, 2, 0])
+        itr.sort_key = lambda x: -len(x.text)
+        self.assertEqual([ex.index for ex in itr.data()], [0, 2, 1])
+        dataset.examples = list(reversed(dataset.examples))
+        self.assertEqual([ex.index for ex in itr.data()], [0, 2, 1])
+        dataset.examples = self.make_dataset([1, 3, 2]).examples
+        self.assertEqual([ex.index for ex in itr.data()], [1, 2, 0])
+
+    def test_sorted_data_with_tuple_keys(self):
+        dataset = self.make_dataset([2, 1, 2, 1])
+        itr = data.Iterator(dataset, batch_size=2, train=False,
+                            sort_key=lambda x: (len(x.text), -x.index))
+        self.assertEqual([ex.index for ex in itr.data()], [3, 1, 2, 0])
+
+    def test_batch_list_and_generator_agree(self):
+        examples = list(range(10))
+        expected = [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+        self.assertEqual(list(data.batch(examples, 4)), expected)
+        self.assertEqual(list(data.batch(iter(examples), 4)), expected)
+
+    def test_pool_chunks_streamed_data_with_large_lookahead(self):
+        # the lookahead chunk must not be preallocated to batch_size * lookahead
+        batches = list(data.pool(iter(range(10)), 4, lambda x: -x,
+                                 batch_size_fn=None, sort_within_batch=True,
+                                 lookahead=10 ** 9))
+        self.assertEqual(batches, [[9, 8, 7, 6], [5, 4, 3, 2], [1, 0]])
+
+    def test_prefetch_yields_same_batches(self):
+        dataset = self.make_dataset([5, 2, 7, 1, 3, 3, 8, 2, 4])
+        for cls in (data.Iterator, data.BucketIterator):
+            itr = cls(dataset, batch_size=2, sort_key=lambda x: len(x.text),
+                      shuffle=False, sort_within_batch=True)
+            expected = [(b.text.tolist(), b.index.tolist()) for b in itr]
+            itr.prefetch_size = 2
+            prefetched = [(b.text.tolist(), b.index.tolist()) for b in itr]
+            self.assertEqual(prefetched, expected)
+            self.assertEqual(itr.iterations, len(expected))
+
+    def test_prefetch_rejected_by_custom_iterators(self):
+        dataset = self.make_dataset([5, 2, 7])
+        for cls in (data.iterator.LazyIterator, data.iterator.LazyBucketIterator):
+            with self.assertRaises(ValueError):
+                cls(dataset, batch_size=2, prefetch_size=2)
+
+        text_field = data.Field()
+        fields = [("text", text_field)]
+        lm = data.Dataset([data.Example.fromlist(["a b c"], fields)], fields)
+        for cls in (data.BPTTIterator, data.iterator.LazyBPTTIterator):
+            with self.assertRaises(ValueError):
+                cls(lm, batch_size=2, bptt_len=2, prefetch_size=2)
+
+    def test_prefetch_reraises_errors(self):
+        def generate():
+            yield 1
+            raise RuntimeError("failed")
+
+        batches = data.iterator.prefetch(generate(), 2)
+        self.assertEqual(next(batches), 1)
+        with self.assertRaises(RuntimeError):
+            next(batches)
+
+    def test_lazy_iterator_reuses_buffer(self):
+        dataset = self.make_dataset([5, 2, 7, 1, 3, 3, 8])
+        itr = data.iterator.LazyIterator(dataset, batch_size=2, buffer_size=3,
+                                         sort_key=lambda x: len(x.text),
+                                         train=False, sort_within_batch=False)
+        buffer = itr.buffer
+        indices = [b.index.tolist() for b in itr]
+        self.assertEqual(indices, [[1, 0], [2], [3, 4], [5], [6]])
+        self.assertIs(itr.buffer, buffer)
+        self.assertEqual(len(itr.buffer), 3)
+
+    def test_token_batch(self):
+        lengths = [1, 2, 2, 3, 4, 9, 12]
+        chunks = list(data.iterator.token_batch(list(range(7)), lengths, 8))
+        self.assertEqual(chunks, [[0, 1, 2], [3, 4], [5], [6]])
+
+    def test_pool_with_token_budget(self):
+        dataset = self.make_dataset([4, 1, 2, 4, 1, 3, 2, 2])
+        batches = list(data.pool(dataset.examples, 4, lambda x: len(x.text),
+                                 sort_within_batch=True, token_budget=6))
+        self.assertEqual([[len(ex.text) for ex in b] for b in batches],
+                         [[1, 1, 2], [2, 2], [3], [4], [4]])
+
+    def test_resume_from_state(self):
+        dataset = self.make_dataset([5, 2, 7, 1, 3, 3, 8, 2, 4])
+        for kwargs in ({"train": False}, {"train": True},
+                       {"train": True, "sort_within_batch": True}):
+            for cls in (data.Iterator, data.BucketIterator):
+                itr = cls(dataset, batch_size=2, sort_key=lambda x: len(x.text),
+                          **kwargs)
+                batches = iter(itr)
+                next(batches)
+                next(batches)
+                state = itr.state_dict()
+                expected = [b.index.tolist() for b in batches]
+                resumed = cls(dataset, batch_size=2,
+                              sort_key=lambda x: len(x.text), **kwargs)
+                resumed.load_state_dict(state)
+                self.assertEqual([b.index.tolist() for b in resumed], expected)
+
+    def test_token_budget(self):
+        lengths = [5, 2, 7, 1, 3, 3, 8, 2, 4, 6, 1, 1, 11]
+        dataset = self.make_dataset(lengths)
+        for cls in (data.Iterator, data.BucketIterator):
+            for kwargs in ({"train": False}, {"train": True},
+                           {"train": True, "sort_within_batch": True}):
+                itr = cls(dataset, batch_size=3, sort_key=lambda x: len(x.text),
+                          token_budget=8, **kwargs)
+                indices = []
+                for b in itr:
+                    batch_lengths = [lengths[i] for i in b.index.tolist()]
+                    self.assertTrue(len(batch_lengths) == 1
+                                    or max(batch_lengths) * len(batch_lengths) <= 8)
+                    indices.extend(b.index.tolist())
+                self.assertEqual(sorted(indices), list(range(len(lengths))))
+
+    def test_bucket_token_budget_evaluates_sort_key_once(self):
+        lengths = [5, 2, 7, 1, 3, 3, 8, 2, 4, 6, 1, 1]
+        dataset = self.make_dataset(lengths)
+        calls = []
+
+        def sort_key(ex):
+            calls.append(ex.index)
+            return len(ex.text)
+
+        itr = data.BucketIterator(dataset, batch_size=3, sort_key=sort_key,
+                                  token_budget=8, train=True,
+                                  sort_within_batch=True)
+        for _ in itr:
+            pass
+        self.assertEqual(sorted(calls), list(range(len(lengths))))
+
+    def test_batch_size_fn_oversized_example(self):
+        lengths = [10, 3, 2, 2]
+        batches = list(data.batch(lengths, 6, lambda new, count, sofar: sofar + new))
+        self.assertEqual(batches, [[10], [3, 2], [2]])
+        dataset = self.make_dataset(lengths)
+        for shuffle in (False, True):
+            itr = data.Iterator(dataset, batch_size=2, sort_key=lambda x: len(x.text),
+                                token_budget=6, train=True, shuffle=shuffle)
+            indices = sorted(i for b in itr for i in b.index.tolist())
+            self.assertEqual(indices, list(range(len(lengths))))
+
+    def test_bptt_iterator(self):
+        text_field = data.Field()
+        fields = [("text", text_field)]
+        tokens = " ".join(str(i) for i in range(20))
+        dataset = data.Dataset([data.Example.fromlist([tokens], fields)], fields)
+        text_field.build_vocab(dataset)
+        itr = data.BPTTIterator(dataset, batch_size=2, bptt_len=4)
+        batches = list(itr)
+        self.assertEqual(len(batches), len(itr))
+        stoi = text_field.vocab.stoi
+        first = batches[0]
+        self.assertEqual(len(first), 2)
+        self.assertEqual(first.text[:, 0].tolist(), [stoi[str(i)] for i in range(4)])
+        self.assertEqual(first.target[:, 1].tolist(),
+                         [stoi[str(i)] for i in range(11, 15)])
+        self.assertEqual(batches[-1].text.size(0), 1)
+
+    def test_bptt_iterator_epochs_do_not_share_storage(self):
+        text_field = data.Field()
+        fields = [("text", text_field)]
+        tokens = " ".join(str(i) for i in range(20))
+        dataset = data.Dataset([data.Example.fromlist([tokens], fields)], fields)
+        text_field.build_vocab(dataset)
+        itr = data.BPTTIterator(dataset, batch_size=2, bptt_len=4)
+        expected = [b.text.tolist() for b in itr]
+        for b in itr:
+            b.text.zero_()
+            b.target.zero_()
+        self.assertEqual([b.text.tolist() for b in itr], expected)
+
+    def test_bptt_iterator_uses_overridden_numericalize(self):
+        class OffsetField(data.Field):
+            def numericalize(self, arr, device=None):
+                return super(OffsetField, self).numericalize(arr, device) + 100
+
+        text_field = OffsetField()
+        fields = [("text", text_field)]
+        tokens = " ".join(str(i) for i in range(20))
+        dataset = data.Dataset([data.Example.fromlist([tokens], fields)], fields)
+        text_field.build_vocab(dataset)
+        itr = data.BPTTIterator(dataset, batch_size=2, bptt_len=4)
+        self.assertTrue(all((b.text >= 100).all() for b in itr))
+
+    def test_bptt_iterator_without_pad_token(self):
+        text_field = data.Field(pad_token=None, unk_token=None)
+        fields = [("text", text_field)]
+        tokens = " ".join(str(i) for i in range(20))
+        dataset = data.Dataset([data.Example.fromlist([tokens], fields)], fields)
+        text_field.build_vocab(dataset)
+        stoi = dict(text_field.vocab.stoi)
+        itr = data.BPTTIterator(dataset, batch_size=2, bptt_len=4)
+        first = next(iter(itr))
+        self.assertEqual(first.text[:, 0].tolist(), [stoi[str(i)] for i in range(4)])
+        self.assertEqual(dict(text_field.vocab.stoi), stoi)
+
+    def test_lazy_bptt_iterator_windows(self):
+        text_field = data.Field()
+        fields = [("text", text_field)]
+        texts = ["0 1 2 3", "4 5 6 7", "8 9 10", "11"]
+        dataset = data.Dataset([data.Example.fromlist([t], fields)
+                                for t in texts], fields)
+        text_field.build_vocab(dataset)
+        itos = text_field.vocab.itos
+        itr = data.iterator.LazyBPTTIterator(dataset, batch_size=1, bptt_len=3,
+                                             buffer_size=2, train=False,
+                                             sort=False, shuffle=False)
+        windows = [([itos[i] for i in b.text[:, 0].tolist()],
+                    [itos[i] for i in b.target[:, 0].tolist()]) for b in itr]
+        # each buffer holds buffer_size * bptt_len tokens; the overflow of
+        # the first buffer (6 7) is dropped
+        self.assertEqual(windows, [
+            (["0", "1", "2"], ["1", "2", "3"]),
+            (["3", "4"], ["4", "5"]),
+            (["8", "9", "10"], ["9", "10", "11"]),
+        ])
+
+    def test_bucket_iterator_sort_within_batch(self):
+        lengths = [5, 2, 7, 1, 3, 3, 8, 2, 4, 6, 1, 1]
+        dataset = self.make_dataset(lengths)
+        itr = data.BucketIterator(dataset, batch_size=3, train=True,
+                                  sort_key=lambda x: len(x.text),
+                                  sort_within_batch=True)
+        for b in itr:
+            batch_lengths = [lengths[i] for i in b.index.tolist()]
+            self.assertEqual(batch_lengths, sorted(batch_lengths, reverse=True))
@@ -1,5 +1,8 @@
+import random
+
 import six
 import torchtext.data as data
+from torchtext.data.utils import RandomShuffler
 
 from ..common.torchtext_test_case import TorchtextTestCase
 
@@ -38,3 +41,16 @@ class TestUtils(TorchtextTestCase):
             data.get_tokenizer(1)
         with self.assertRaises(ValueError):
             data.get_tokenizer("some other string")
+
+    def test_random_shuffler_state(self):
+        shuffler = RandomShuffler()
+        state = shuffler.random_state
+        first = shuffler(list(range(20)))
+        self.assertEqual(sorted(first), list(range(20)))
+        shuffler.random_state = state
+        self.assertEqual(shuffler(list(range(20))), first)
+
+        # a state of the random module seeds the shuffler deterministically
+        legacy_state = random.getstate()
+        self.assertEqual(RandomShuffler(legacy_state).permutation(20).tolist(),
+                         RandomShuffler(legacy_state).permutation(20).tolist())
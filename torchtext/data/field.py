@@ -1,6 +1,7 @@
 # coding: utf8
 from collections import Counter, OrderedDict
 from itertools import chain
+import numpy as np
 import six
 import torch
 from tqdm import tqdm
@@ -233,10 +234,54 @@ class Field(RawField):
             torch.autograd.Variable: Processed object given the input
             and custom postprocessing Pipeline.
         """
+        if self._can_process_ids_directly():
+            return self._process_ids(batch, device=device)
         padded = self.pad(batch)
         tensor = self.numericalize(padded, device=device)
         return tensor
 
+    def _can_process_ids_directly(self):
+        # only the plain Field pad/numericalize behavior is reproduced by
+        # `_process_ids`; anything else goes through `pad` and `numericalize`
+        return (self.sequential and self.use_vocab and self.fix_length is None
+                and self.pad_token is not None and self.postprocessing is None
+                and type(self).pad is Field.pad
+                and type(self).numericalize is Field.numericalize)
+
+    def _process_ids(self, batch, device=None):
+        """Pad and numericalize a batch in one pass.
+
+        Looks the token ids up straight into a (batch, max_len) array filled
+        with the padding id, instead of building padded token lists first.
+        Equivalent to `numericalize(pad(batch))` for a sequential Field with
+        a vocab, no fixed length and no postprocessing.
+        """
+        batch = list(batch)
+        stoi = self.vocab.stoi
+        specials = ([] if self.init_token is None else [self.init_token],
+                    [] if self.eos_token is None else [self.eos_token])
+        lengths = np.fromiter((len(x) for x in batch), dtype=np.int64,
+                              count=len(batch))
+        lengths += len(specials[0]) + len(specials[1])
+        max_len = int(lengths.max())
+        tokens = chain.from_iterable(chain(specials[0], x, specials[1]) for x in batch)
+        ids = np.full((len(batch), max_len), stoi[self.pad_token], dtype=np.int64)
+        positions = np.arange(max_len)
+        if self.pad_first:
+            mask = positions >= (max_len - lengths)[:, None]
+        else:
+            mask = positions < lengths[:, None]
+        ids[mask] = np.fromiter(map(stoi.__getitem__, tokens), dtype=np.int64,
+                                count=int(lengths.sum()))
+
+        var = torch.from_numpy(ids).to(device=device, dtype=self.dtype)
+        if not self.batch_first:
+            var = var.t()
+        var = var.contiguous()
+        if self.include_lengths:
+            return var, torch.tensor(lengths, dtype=self.dtype, device=device)
+        return var
+
     def pad(self, minibatch):
         """Pad a batch of examples using this field.
 
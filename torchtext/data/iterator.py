@@ -2,9 +2,17 @@ from __future__ import division
 
 import math
 import random
+import threading
+from collections import deque, namedtuple
+from functools import partial
+from itertools import islice
+from queue import Queue, Full
 
 import logging
 
+import numpy as np
+import torch
+
 from .utils import RandomShuffler
 from .batch import Batch
 from .dataset import Dataset
@@ -40,14 +48,28 @@ class Iterator(object):
         device (str or `torch.device`): A string or instance of `torch.device`
             specifying which device the Variables are going to be created on.
             If left as default, the tensors will be created on cpu. Default: None.
+        prefetch_size: Number of batches to build ahead of time in a background
+            thread, so that numericalization and the host to device copy overlap
+            with the consumer's work. If 0, batches are built on demand in the
+            calling thread. Only Iterator and BucketIterator support
+            prefetching; the other iterators raise a ValueError if it is
+            positive. Default: 0.
+        token_budget: If not None, batches are sized by their padded number of
+            tokens instead of by their number of examples: a batch holds as
+            many examples as fit in token_budget once padded to the longest
+            one, with lengths given by sort_key. batch_size and batch_size_fn
+            are then only used by the bucketing iterators, to size the chunks
+            of examples that are sorted and packed together (see pool).
+            Default: None.
     """
 
     def __init__(self, dataset, batch_size, sort_key=None, device=None,
                  batch_size_fn=None, train=True,
                  repeat=False, shuffle=None, sort=None,
-                 sort_within_batch=None):
+                 sort_within_batch=None, prefetch_size=0, token_budget=None):
         self.batch_size, self.train, self.dataset = batch_size, train, dataset
         self.batch_size_fn = batch_size_fn
+        self.token_budget = token_budget
         self.iterations = 0
         self.repeat = repeat
         self.shuffle = train if shuffle is None else shuffle
@@ -68,12 +90,23 @@ class Iterator(object):
                            + " deprecated soon and currently defaults to cpu.")
             device = None
         self.device = device
+        self.prefetch_size = prefetch_size
         self.random_shuffler = RandomShuffler()
 
+        # Set by create_batches when every minibatch is already in ascending
+        # sort_key order, so sorting within a batch only needs a reverse
+        self._batches_are_sorted_ascending = False
+
+        # Sort keys are computed once and reused across epochs
+        self._sort_keys = None
+        self._sort_order = None
+        self._sort_cache_owner = None
+
         # For state loading/saving only
         self._iterations_this_epoch = 0
         self._random_state_this_epoch = None
         self._restored_from_state = False
+        self._batches_skipped = 0
 
     @classmethod
     def splits(cls, datasets, batch_sizes=None, **kwargs):
@@ -99,13 +132,43 @@ class Iterator(object):
     def data(self):
         """Return the examples in the dataset in order, sorted, or shuffled."""
         if self.sort:
-            xs = sorted(self.dataset, key=self.sort_key)
+            xs = [self.dataset[i] for i in self.sort_order()]
         elif self.shuffle:
-            xs = [self.dataset[i] for i in self.random_shuffler(range(len(self.dataset)))]
+            order = self.random_shuffler.permutation(len(self.dataset))
+            xs = [self.dataset[i] for i in order.tolist()]
         else:
             xs = self.dataset
         return xs
 
+    def sort_order(self):
+        """Return the indices of the dataset examples sorted by self.sort_key.
+
+        The sort keys are computed once and cached. The order is recomputed
+        if self.sort_key is reassigned, or if the dataset's examples are
+        replaced or change in number; examples modified in place are not
+        detected.
+        """
+        examples = getattr(self.dataset, 'examples', self.dataset)
+        owner = self._sort_cache_owner
+        if (owner is None or owner[0] is not examples
+                or owner[1] is not self.sort_key
+                or len(self._sort_keys) != len(self.dataset)):
+            self._sort_cache_owner = (examples, self.sort_key)
+            keys = [self.sort_key(ex) for ex in self.dataset]
+            try:
+                self._sort_keys = np.asarray(keys)
+            except ValueError:
+                self._sort_keys = None
+            if (self._sort_keys is not None and self._sort_keys.ndim == 1
+                    and self._sort_keys.dtype.kind in 'iuf'):
+                self._sort_order = np.argsort(self._sort_keys, kind='stable').tolist()
+            else:
+                # keys NumPy cannot compare natively (e.g. tuples) fall back
+                # to a Python sort
+                self._sort_keys = keys
+                self._sort_order = sorted(range(len(keys)), key=keys.__getitem__)
+        return self._sort_order
+
     def init_epoch(self):
         """Set up the batch generator for a new epoch."""
 
@@ -114,6 +177,7 @@ class Iterator(object):
         else:
             self._random_state_this_epoch = self.random_shuffler.random_state
 
+        self._batches_skipped = 0
         self.create_batches()
 
         if self._restored_from_state:
@@ -125,35 +189,82 @@ class Iterator(object):
             self.iterations = 0
 
     def create_batches(self):
-        self.batches = batch(self.data(), self.batch_size, self.batch_size_fn)
+        xs = self.data()
+        if (self._restored_from_state and self.batch_size_fn is None
+                and self.token_budget is None and isinstance(xs, list)):
+            # batches are fixed-size slices: seek straight to the first batch
+            # that was not consumed before the state was saved
+            self._batches_skipped = self._iterations_this_epoch
+            xs = xs[self._batches_skipped * self.batch_size:]
+        self.batches = self._batch(xs)
+
+    def _batch(self, data):
+        """Batch data in order, by token_budget if set or else by batch_size."""
+        if self.token_budget is not None:
+            return batch(data, self.token_budget, self._padded_size)
+        return batch(data, self.batch_size, self.batch_size_fn)
+
+    def _padded_size(self, new, count, sofar):
+        """batch_size_fn counting the padded tokens of a batch."""
+        # sofar is the longest length so far times the previous count
+        longest = sofar // (count - 1) if count > 1 else 0
+        return max(longest, self.sort_key(new)) * count
 
     @property
     def epoch(self):
         return math.floor(self.iterations / len(self))
 
     def __len__(self):
-        if self.batch_size_fn is not None:
+        if self.batch_size_fn is not None or self.token_budget is not None:
             raise NotImplementedError
         return math.ceil(len(self.dataset) / self.batch_size)
 
+    def _make_batch(self, minibatch, device=None):
+        """Create a Batch from a minibatch of examples."""
+        if self.sort_within_batch:
+            # NOTE: `rnn.pack_padded_sequence` requires that a minibatch
+            # be sorted by decreasing order, which requires reversing
+            # relative to typical sort keys
+            if self.sort or self._batches_are_sorted_ascending:
+                minibatch.reverse()
+            else:
+                # list.sort() evaluates sort_key once per example and is
+                # stable, so equal keys keep their batch order
+                minibatch.sort(key=self.sort_key, reverse=True)
+        return Batch(minibatch, self.dataset, device)
+
+    def _check_no_prefetch(self):
+        """Reject prefetch_size in subclasses that define their own __iter__."""
+        if self.prefetch_size > 0:
+            raise ValueError("{} does not support prefetching, prefetch_size "
+                             "must be 0".format(type(self).__name__))
+
+    def _make_batch_pinned(self, minibatch):
+        """Create a Batch on cpu and copy it asynchronously from pinned memory."""
+        batch = self._make_batch(minibatch)
+        for name in batch.fields:
+            if hasattr(batch, name):
+                setattr(batch, name, _pin_to_device(getattr(batch, name), self.device))
+        return batch
+
     def __iter__(self):
         while True:
             self.init_epoch()
-            for idx, minibatch in enumerate(self.batches):
-                # fast-forward if loaded from state
-                if self._iterations_this_epoch > idx:
-                    continue
+            # fast-forward if loaded from state
+            minibatches = islice(self.batches,
+                                 self._iterations_this_epoch - self._batches_skipped,
+                                 None)
+            if self.prefetch_size > 0 and _is_cuda(self.device):
+                make_batch = self._make_batch_pinned
+            else:
+                make_batch = partial(self._make_batch, device=self.device)
+            batches = map(make_batch, minibatches)
+            if self.prefetch_size > 0:
+                batches = prefetch(batches, self.prefetch_size)
+            for batch in batches:
                 self.iterations += 1
                 self._iterations_this_epoch += 1
-                if self.sort_within_batch:
-                    # NOTE: `rnn.pack_padded_sequence` requires that a minibatch
-                    # be sorted by decreasing order, which requires reversing
-                    # relative to typical sort keys
-                    if self.sort:
-                        minibatch.reverse()
-                    else:
-                        minibatch.sort(key=self.sort_key, reverse=True)
-                yield Batch(minibatch, self.dataset, self.device)
+                yield batch
             if not self.repeat:
                 return
 
@@ -176,8 +287,9 @@ class BPTTIterator(Iterator):
     Provides contiguous streams of examples together with targets that are
     one timestep further forward, for language modeling training with
     backpropagation through time (BPTT). Expects a Dataset with a single
-    example and a single field called 'text' and produces Batches with text and
-    target attributes.
+    example and a single field called 'text' and produces batches with text and
+    target attributes. The batches are light named tuples that also expose the
+    dataset, batch_size and fields attributes of a Batch.
 
     Attributes:
         dataset: The Dataset object to load Examples from.
@@ -204,11 +316,16 @@ class BPTTIterator(Iterator):
             self, dataset, batch_size, bptt_len, randomized_bptt_len=False, **kwargs
     ):
         super(BPTTIterator, self).__init__(dataset, batch_size, **kwargs)
+        self._check_no_prefetch()
         self.bptt_len = bptt_len
         self.cur_bptt_len = bptt_len
         self.randomized_bptt_len = randomized_bptt_len
         self.field_name = self.get_unique_field_name(self.dataset.fields)
         self.batch_first = self.dataset.fields[self.field_name].batch_first
+        self._batch_cls = _bptt_batch_type(self.field_name)
+        # the text and its numericalized form do not change between epochs
+        self._text_len = None
+        self._prepared = None
 
     def get_unique_field_name(self, fields):
         assert len(fields) == 1  # maybe remove this assert?
@@ -222,8 +339,13 @@ class BPTTIterator(Iterator):
         self.cur_bptt_len = max(10, self.cur_bptt_len)
 
     def __len__(self):
-        return math.ceil((len(self.dataset[0].text) / self.batch_size - 1)
-                         / self.cur_bptt_len)
+        if self._text_len is None:
+            self._text_len = len(getattr(self.dataset[0], self.field_name))
+        return self.num_windows(self._text_len)
+
+    def num_windows(self, text_len):
+        """Return the number of BPTT windows over a text of text_len tokens."""
+        return math.ceil((text_len / self.batch_size - 1) / self.cur_bptt_len)
 
     def prepare_text(self, text):
         """ text is a list of str """
@@ -232,32 +354,69 @@ class BPTTIterator(Iterator):
 
         nb_batches = math.ceil(len(text) / self.batch_size)
         nb_iters = nb_batches * self.batch_size
-        text = text + [text_field.pad_token] * int(nb_iters - len(text))
-
-        data = text_field.numericalize([text], device=self.device)
+        if text_field._can_process_ids_directly():
+            # look the ids up straight into a preallocated, padded tensor
+            stoi = text_field.vocab.stoi
+            data = torch.full((nb_iters,), stoi[text_field.pad_token],
+                              dtype=text_field.dtype)
+            ids = np.fromiter(map(stoi.__getitem__, text), dtype=np.int64,
+                              count=len(text))
+            data[:len(text)] = torch.from_numpy(ids)
+            data = data.to(self.device)
+        else:
+            text = text + [text_field.pad_token] * int(nb_iters - len(text))
+            data = text_field.numericalize([text], device=self.device)
         data = data.view(self.batch_size, -1).t().contiguous()
         aux_fields = [(self.field_name, text_field), ('target', text_field)]
         aux_dataset = Dataset(self.dataset.examples, aux_fields)
         return data, aux_dataset
 
-    def __iter__(self):
-        text = getattr(self.dataset[0], self.field_name)
-        data, dataset = self.prepare_text(text)
-        while True:
-            for i in range(0, len(self) * self.cur_bptt_len, self.cur_bptt_len):
-                self.iterations += 1
-                seq_len = min(self.cur_bptt_len, len(data) - i - 1)
-                batch_text = data[i:i + seq_len]
-                batch_target = data[i + 1:i + 1 + seq_len]
+    def bptt_windows(self, data, num_windows):
+        """Yield the text and target of the first num_windows BPTT windows.
+
+        The full windows are read from a single strided view of data, in which
+        each window spans self.cur_bptt_len + 1 timesteps; only a trailing
+        shorter window is sliced separately.
+        """
+        bptt_len = self.cur_bptt_len
+        if len(data) > bptt_len:
+            windows = data.unfold(0, bptt_len + 1, bptt_len)
+        else:
+            windows = data.new_empty((0,))
+        for i in range(num_windows):
+            if i < len(windows):
+                # windows[i] is (batch, bptt_len + 1)
+                batch_text = windows[i, :, :-1]
+                batch_target = windows[i, :, 1:]
+                if self.batch_first:
+                    batch_text = batch_text.contiguous()
+                    batch_target = batch_target.contiguous()
+                else:
+                    batch_text = batch_text.t()
+                    batch_target = batch_target.t()
+            else:
+                start = i * bptt_len
+                seq_len = min(bptt_len, len(data) - start - 1)
+                batch_text = data[start:start + seq_len]
+                batch_target = data[start + 1:start + 1 + seq_len]
                 if self.batch_first:
                     batch_text = batch_text.t().contiguous()
                     batch_target = batch_target.t().contiguous()
-                yield Batch.fromvars(
-                    dataset,
-                    self.batch_size,
-                    text=batch_text,
-                    target=batch_target
-                )
+            yield batch_text, batch_target
+
+    def __iter__(self):
+        if self._prepared is None:
+            text = getattr(self.dataset[0], self.field_name)
+            self._prepared = self.prepare_text(text)
+        prepared, dataset = self._prepared
+        while True:
+            # the batches are views into the epoch's data, so each epoch gets
+            # its own copy and in-place edits to a batch cannot leak into the
+            # next epoch
+            data = prepared.clone()
+            for batch_text, batch_target in self.bptt_windows(data, len(self)):
+                self.iterations += 1
+                yield self._batch_cls(dataset, self.batch_size, batch_text, batch_target)
             if not self.repeat:
                 return
 
@@ -271,14 +430,16 @@ class BucketIterator(Iterator):
 
     def create_batches(self):
         if self.sort:
-            self.batches = batch(self.data(), self.batch_size,
-                                 self.batch_size_fn)
+            super(BucketIterator, self).create_batches()
         else:
+            # pool sorts each chunk before batching it if sort_within_batch
+            self._batches_are_sorted_ascending = self.sort_within_batch
             self.batches = pool(self.data(), self.batch_size,
                                 self.sort_key, self.batch_size_fn,
                                 random_shuffler=self.random_shuffler,
                                 shuffle=self.shuffle,
-                                sort_within_batch=self.sort_within_batch)
+                                sort_within_batch=self.sort_within_batch,
+                                token_budget=self.token_budget)
 
 
 class LazyIterator(Iterator):
@@ -293,29 +454,50 @@ class LazyIterator(Iterator):
 
     def __init__(self, *args, buffer_size=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.buffer = []
+        self._check_no_prefetch()
         if buffer_size is None:
             # minibatches will have the same size if buffer_size
             # is divisible by batch_size
             buffer_size = self.batch_size * 2 ** 10
         self.buffer_size = buffer_size
+        # the buffer is allocated once and overwritten in place; only its
+        # first `_buf_n` slots hold examples of the current fill
+        self.buffer = [None] * self.buffer_size
+        self._buf_n = 0
+        self._buffer_order = range(0)
         self.batches = None
 
     def data(self):
         return iter(self.dataset)
 
+    def add_to_buffer(self, ex):
+        """Store an example in the buffer and return whether it is full."""
+        self.buffer[self._buf_n] = ex
+        self._buf_n += 1
+        return self._buf_n == self.buffer_size
+
     def clear_buffer(self):
-        self.buffer.clear()
+        self._buf_n = 0
+
+    def buffered_examples(self):
+        """Iterate over the buffered examples in the order set by prepare_buffer."""
+        return (self.buffer[i] for i in self._buffer_order)
 
     def prepare_buffer(self):
         if self.sort:
-            self.buffer.sort(key=self.sort_key)
+            if self._buf_n == self.buffer_size:
+                self.buffer.sort(key=self.sort_key)
+            else:
+                self.buffer[:self._buf_n] = sorted(self.buffer[:self._buf_n],
+                                                   key=self.sort_key)
+            self._buffer_order = range(self._buf_n)
         elif self.shuffle:
-            buffer_size = range(len(self.buffer))
-            self.buffer = [self.buffer[i] for i in self.random_shuffler(buffer_size)]
+            self._buffer_order = self.random_shuffler.permutation(self._buf_n)
+        else:
+            self._buffer_order = range(self._buf_n)
 
     def create_batches(self):
-        self.batches = batch(self.buffer, self.batch_size, self.batch_size_fn)
+        self.batches = self._batch(self.buffered_examples())
 
     def consume_buffer(self):
         self.prepare_buffer()
@@ -323,12 +505,7 @@ class LazyIterator(Iterator):
         for minibatch in self.batches:
             self.iterations += 1
             self._iterations_this_epoch += 1
-            if self.sort_within_batch:
-                if self.sort:
-                    minibatch.reverse()
-                else:
-                    minibatch.sort(key=self.sort_key, reverse=True)
-            yield Batch(minibatch, self.dataset, self.device)
+            yield self._make_batch(minibatch, self.device)
 
     def __iter__(self):
         while True:
@@ -336,14 +513,13 @@ class LazyIterator(Iterator):
             self.clear_buffer()
 
             for ex in self.data():
-                self.buffer.append(ex)
-                if len(self.buffer) == self.buffer_size:
+                if self.add_to_buffer(ex):
                     for batch in self.consume_buffer():
                         yield batch
                     self.clear_buffer()
 
             # in case the buffer is not empty
-            if len(self.buffer) > 0:
+            if self._buf_n > 0:
                 for batch in self.consume_buffer():
                     yield batch
                 self.clear_buffer()
@@ -356,79 +532,61 @@ class LazyBucketIterator(BucketIterator, LazyIterator):
 
     def create_batches(self):
         if self.sort:
-            self.batches = batch(self.buffer,
-                                 self.batch_size,
-                                 self.batch_size_fn)
+            self.batches = self._batch(self.buffered_examples())
         else:
-            self.batches = pool(self.buffer,
+            self._batches_are_sorted_ascending = self.sort_within_batch
+            self.batches = pool(self.buffered_examples(),
                                 self.batch_size,
                                 self.sort_key,
                                 self.batch_size_fn,
                                 random_shuffler=self.random_shuffler,
                                 shuffle=self.shuffle,
                                 sort_within_batch=self.sort_within_batch,
-                                lookahead=self.buffer_size)
+                                lookahead=self.buffer_size,
+                                token_budget=self.token_budget)
 
 
 class LazyBPTTIterator(BPTTIterator, LazyIterator):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.prev_text_buffer = []
+        self.prev_text_buffer = deque()
 
     def __len__(self):
-        return self.get_len(self.buffer)
+        return self.num_windows(self._buf_n)
 
     def get_len(self, text_buffer):
-        return math.ceil((len(text_buffer) / self.batch_size - 1) / self.cur_bptt_len)
+        return self.num_windows(len(text_buffer))
 
     def clear_buffer(self):
-        self.buffer.clear()
+        super().clear_buffer()
         self.prev_text_buffer.clear()
 
     def get_contiguous_buffer(self):
-        text_buffer = []
-        while (
-            len(text_buffer) < self.buffer_size * self.cur_bptt_len
-            and len(self.prev_text_buffer) > 0
-        ):
-            text_buffer.append(self.prev_text_buffer.pop(0))
+        remaining = self.buffer_size * self.cur_bptt_len
+        take = min(remaining, len(self.prev_text_buffer))
+        text_buffer = [self.prev_text_buffer.popleft() for _ in range(take)]
+        remaining -= take
         if len(text_buffer) == self.cur_bptt_len:
             return text_buffer
-        for ex in self.buffer:
+        for ex in islice(self.buffer, self._buf_n):
             text = getattr(ex, self.field_name)
-            self.prev_text_buffer = []
-            for w in text:
-                if len(text_buffer) + 1 <= self.buffer_size * self.cur_bptt_len:
-                    text_buffer.append(w)
-                else:
-                    self.prev_text_buffer.append(w)
+            take = min(len(text), remaining)
+            text_buffer.extend(text[:take])
+            remaining -= take
+            if take < len(text):
+                # keep the tokens that did not fit for the next buffer
+                self.prev_text_buffer = deque(text[take:])
+                break
         return text_buffer
 
     def prepare_text_buffer(self, text):
         """ text is a list of str """
-        text_field = self.dataset.fields[self.field_name]
-        text_field.eos_token = None  # this should be optional
-
-        nb_batches = math.ceil(len(text) / self.batch_size)
-        nb_iters = nb_batches * self.batch_size
-        text = text + [text_field.pad_token] * int(nb_iters - len(text))
-
-        data = text_field.numericalize([text], device=self.device)
-        data = data.view(self.batch_size, -1).t().contiguous()
-        aux_fields = [(self.field_name, text_field), ('target', text_field)]
-        aux_dataset = Dataset(self.dataset.examples, aux_fields)
-        return data, aux_dataset
+        return self.prepare_text(text)
 
     def consume_data(self, data, text_len):
-        for i in range(0, text_len * self.cur_bptt_len, self.cur_bptt_len):
+        for batch_text, batch_target in self.bptt_windows(data, text_len):
             self.iterations += 1
-            seq_len = min(self.cur_bptt_len, len(data) - i - 1)
-            batch_text = data[i:i + seq_len]
-            batch_target = data[i + 1:i + 1 + seq_len]
-            if self.batch_first:
-                batch_text = batch_text.t().contiguous()
-                batch_target = batch_target.t().contiguous()
             yield batch_text, batch_target
 
     def consume_buffer(self):
@@ -436,12 +594,7 @@ class LazyBPTTIterator(BPTTIterator, LazyIterator):
         data, dataset = self.prepare_text_buffer(cur_text_buffer)
         t_len = self.get_len(cur_text_buffer)
         for batch_text, batch_target in self.consume_data(data, t_len):
-            kwargs = {self.field_name: batch_text, 'target': batch_target}
-            yield Batch.fromvars(
-                dataset,
-                self.batch_size,
-                **kwargs
-            )
+            yield self._batch_cls(dataset, self.batch_size, batch_text, batch_target)
 
     def __iter__(self):
         while True:
@@ -452,14 +605,13 @@ class LazyBPTTIterator(BPTTIterator, LazyIterator):
                 self.set_random_bptt_len()
 
             for ex in self.data():
-                self.buffer.append(ex)
-                if len(self.buffer) == self.buffer_size:
+                if self.add_to_buffer(ex):
                     for batch in self.consume_buffer():
                         yield batch
                     self.clear_buffer()
 
             # in case the buffer is not empty
-            if len(self.buffer) > 0:
+            if self._buf_n > 0:
                 for batch in self.consume_buffer():
                     yield batch
                 self.clear_buffer()
@@ -468,11 +620,47 @@ class LazyBPTTIterator(BPTTIterator, LazyIterator):
                 return
 
 
+def _bptt_batch_type(field_name):
+    """Return a named tuple type for the batches of a BPTT iterator."""
+    base = namedtuple('BPTTBatch', ['dataset', 'batch_size', field_name, 'target'])
+
+    class BPTTBatch(base):
+        __slots__ = ()
+
+        @property
+        def fields(self):
+            return self.dataset.fields.keys()
+
+        def __len__(self):
+            return self.batch_size
+
+    return BPTTBatch
+
+
 def batch(data, batch_size, batch_size_fn=None):
     """Yield elements from data in chunks of batch_size."""
     if batch_size_fn is None:
-        def batch_size_fn(new, count, sofar):
-            return count
+        if isinstance(data, list):
+            # constant batch size over materialized data: batches are slices
+            for i in range(0, len(data), batch_size):
+                yield data[i:i + batch_size]
+        else:
+            # fill one reusable buffer and yield exact-size copies of it;
+            # the buffer grows with the data rather than being preallocated,
+            # since pool() chunks with batch_size * lookahead
+            buf, n = [], 0
+            for ex in data:
+                if n < len(buf):
+                    buf[n] = ex
+                else:
+                    buf.append(ex)
+                n += 1
+                if n == batch_size:
+                    yield buf[:]
+                    n = 0
+            if n:
+                yield buf[:n]
+        return
     minibatch = []
     size_so_far = 0
     for ex in data:
@@ -482,29 +670,129 @@ def batch(data, batch_size, batch_size_fn=None):
             yield minibatch
             minibatch, size_so_far = [], 0
         elif size_so_far > batch_size:
-            yield minibatch[:-1]
-            minibatch, size_so_far = minibatch[-1:], batch_size_fn(ex, 1, 0)
+            if len(minibatch) == 1:
+                # an example that alone exceeds batch_size forms its own batch
+                yield minibatch
+                minibatch, size_so_far = [], 0
+            else:
+                yield minibatch[:-1]
+                minibatch, size_so_far = minibatch[-1:], batch_size_fn(ex, 1, 0)
     if minibatch:
         yield minibatch
 
 
+def prefetch(iterable, size):
+    """Consume an iterable in a background thread, buffering up to size items.
+
+    Exceptions raised while consuming the iterable are re-raised in the
+    calling thread. The background thread stops when the returned generator
+    is exhausted or closed.
+    """
+    queue = Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _is_cuda(device):
+    return device is not None and torch.device(device).type == 'cuda'
+
+
+def _pin_to_device(value, device):
+    """Copy a cpu tensor (or tuple of tensors) to device from pinned memory."""
+    if isinstance(value, tuple):
+        return tuple(_pin_to_device(v, device) for v in value)
+    if torch.is_tensor(value):
+        return value.pin_memory().to(device, non_blocking=True)
+    return value
+
+
+def token_batch(data, lengths, token_budget):
+    """Yield contiguous chunks of data whose padded size fits token_budget.
+
+    The padded size of a chunk is the largest of its lengths times the number
+    of examples in it. Chunks are filled greedily, in order; an example that
+    alone exceeds token_budget forms a chunk of its own.
+
+    Arguments:
+        data: A list of examples.
+        lengths: The length of each example in data.
+        token_budget: The maximum padded size of a chunk.
+    """
+    lengths = np.asarray(lengths)
+    start = 0
+    while start < len(data):
+        # the running maximum is at least lengths[start], which bounds how
+        # many examples can fit
+        if lengths[start] > 0:
+            window = lengths[start:start + max(token_budget // int(lengths[start]), 1)]
+        else:
+            window = lengths[start:]
+        sizes = np.maximum.accumulate(window) * np.arange(1, len(window) + 1)
+        end = start + max(int(np.searchsorted(sizes, token_budget, side='right')), 1)
+        yield data[start:end]
+        start = end
+
+
 def pool(data, batch_size, key, batch_size_fn=lambda new, count, sofar: count,
          random_shuffler=None, shuffle=False, sort_within_batch=False,
-         lookahead=100):
+         lookahead=100, token_budget=None):
     """Sort within buckets, then batch, then shuffle batches.
     Partitions data into chunks of size lookahead*batch_size, sorts examples within
     each chunk using sort_key, then batch these examples and shuffle the
-    batches.
+    batches. If token_budget is given, sort_key must return the length of an
+    example and the examples of each chunk are packed with token_batch instead.
     """
     if random_shuffler is None:
-        random_shuffler = random.shuffle
+        random_shuffler = RandomShuffler()
     for p in batch(data, batch_size * lookahead, batch_size_fn):
-        if sort_within_batch:
-            p = sorted(p, key=key)
-        p_batch = batch(p, batch_size, batch_size_fn)
+        if token_budget is not None:
+            lengths = np.fromiter(map(key, p), dtype=np.int64, count=len(p))
+            if sort_within_batch:
+                order = np.argsort(lengths, kind='stable')
+                p = [p[i] for i in order.tolist()]
+                lengths = lengths[order]
+            p_batch = token_batch(p, lengths, token_budget)
+        else:
+            if sort_within_batch:
+                p = sorted(p, key=key)
+            p_batch = batch(p, batch_size, batch_size_fn)
         if shuffle:
-            for b in random_shuffler(list(p_batch)):
-                yield b
+            # shuffle the batch indices only, the batches are not copied
+            p_batch = list(p_batch)
+            for i in random_shuffler(range(len(p_batch))):
+                yield p_batch[i]
         else:
             for b in p_batch:
                 yield b
@@ -1,9 +1,10 @@
 import random
-from contextlib import contextmanager
 from copy import deepcopy
 
 from functools import partial
 
+import numpy as np
+
 
 def _split_tokenizer(x):
     return x.split()
@@ -116,31 +117,36 @@ def dtype_to_attr(dtype):
 
 class RandomShuffler(object):
     """Use random functions while keeping track of the random state to make it
-    reproducible and deterministic."""
+    reproducible and deterministic.
+
+    Permutations are drawn from a NumPy PCG64 generator. The random state is
+    the state dict of its bit generator; a state returned by
+    `random.getstate()` is also accepted and seeds the generator. If no state
+    is given, the generator is seeded from the current state of the `random`
+    module, so `random.seed` keeps controlling the shuffles.
+    """
 
     def __init__(self, random_state=None):
-        self._random_state = random_state
-        if self._random_state is None:
-            self._random_state = random.getstate()
-
-    @contextmanager
-    def use_internal_state(self):
-        """Use a specific RNG state."""
-        old_state = random.getstate()
-        random.setstate(self._random_state)
-        yield
-        self._random_state = random.getstate()
-        random.setstate(old_state)
+        self._rng = np.random.Generator(np.random.PCG64())
+        if random_state is None:
+            random_state = random.getstate()
+        self.random_state = random_state
 
     @property
     def random_state(self):
-        return deepcopy(self._random_state)
+        return deepcopy(self._rng.bit_generator.state)
 
     @random_state.setter
     def random_state(self, s):
-        self._random_state = s
+        if isinstance(s, tuple):
+            # a state of the `random` module: (version, internal state, gauss)
+            s = np.random.PCG64(np.random.SeedSequence(list(s[1]))).state
+        self._rng.bit_generator.state = s
+
+    def permutation(self, n):
+        """Return a random permutation of range(n) as a NumPy array."""
+        return self._rng.permutation(n)
 
     def __call__(self, data):
         """Shuffle and return a new list."""
-        with self.use_internal_state():
-            return random.sample(data, len(data))
+        return [data[i] for i in self.permutation(len(data)).tolist()]